@@ -12,53 +12,71 @@
 import os
 import sys
 import argparse
-import json
+import functools
 import logging
+import multiprocessing
 import re
 from datetime import datetime
 
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 log = logging.getLogger(__name__)
 
 def parse_tags(text_entities):
 
-    tags = []
-    for obj in text_entities:
-        if obj['type'] == 'hashtag':
-            tags.append(obj['text'])
+    if not text_entities:
+        return ''
 
-    return ' '.join(tags)
+    return ' '.join(obj['text'] for obj in text_entities if obj['type'] == 'hashtag')
 
-def print_default_post_header(post, user_id):
+# static parts of the default post header
+HEADER_OPEN = b'---\n'
+HEADER_CLOSE = b'layout: post\n---\n'
+
+def print_default_post_header(post, self_id, post_date):
 
     '''
-    returns default post header
+    returns default post header as UTF-8 encoded bytes,
+    self_id is the channel owner's from_id (e.g. 'user123')
     '''
 
     post_title = post['id']
-    post_date = datetime.fromisoformat(post['date'])
     post_tags = parse_tags(post['text_entities'])
 
+    from_other = post.get('from_id', self_id) != self_id
+
     # TODO: support for custom header
-    post_header = f'---\ntitle: {post_title}\ndate: {post_date}\n'
+    # most posts are plain posts of the channel owner
+    if not (post_tags or from_other or 'forwarded_from' in post or 'saved_from' in post):
+        return HEADER_OPEN + f'title: {post_title}\ndate: {post_date}\n'.encode('utf-8') + HEADER_CLOSE
+
+    post_header = [f'title: {post_title}\ndate: {post_date}\n']
 
     if post_tags:
-        post_header += f'tags: {post_tags}\n'
+        post_header.append(f'tags: {post_tags}\n')
 
-    if 'from_id' in post:
-        if post['from_id'] != f'user{user_id}':
-            from_header = "from: '{name}' ({user_id})\n"
-            post_header += from_header.format(name=post['from'], user_id=post['from_id'])
+    if from_other:
+        post_header.append(f"from: '{post['from']}' ({post['from_id']})\n")
 
     if 'forwarded_from' in post:
-        post_header += "forwarded\\_from: '{}'\n".format(post['forwarded_from'])
+        post_header.append("forwarded\\_from: '{}'\n".format(post['forwarded_from']))
 
     if 'saved_from' in post:
-        post_header += "saved\\_from: '{}'\n".format(post['saved_from'])
+        post_header.append("saved\\_from: '{}'\n".format(post['saved_from']))
 
-    post_header += 'layout: post\n'\
-                   '---\n'
+    header = bytearray(HEADER_OPEN)
+    header += ''.join(post_header).encode('utf-8')
+    header += HEADER_CLOSE
 
-    return post_header
+    return bytes(header)
 
 
 def print_custom_post_header(post_header_file, *args):
@@ -85,37 +103,49 @@ def parse_post_photo(post, photo_dir):
     return post_photo
 
 
-def text_format(string, fmt):
+def trailing_newlines(string):
 
     '''
-    wraps string in markdown-styled formatting
+    returns newlines to restore after the string has been stripped
     '''
 
-    if fmt in ('*', '**', '***', '`', '```'):
-        output = '{fmt}{txt}{fmt}'
-    elif fmt == '```':
-        output = '{fmt}\n{txt}\n{fmt}'
-    else:
-        output = '<{fmt}>{txt}</{fmt}>'
+    # endswith() rejects most strings before anything is counted, and
+    # split() and count() already scan the buffer in C, so there is
+    # nothing left for a JIT-compiled loop to win back
+    return '\n' * string.split('\n').count('') if string.endswith('\n') else ''
+
 
-    output = output.format(fmt=fmt, txt=string.strip())
-    output += '\n' * string.split('\n').count('') * string.endswith('\n')
-    return output
+# markdown-styled formatting, one function per text object type
+def format_italic(string):
+    return f'*{string.strip()}*' + trailing_newlines(string)
 
+def format_bold(string):
+    return f'**{string.strip()}**' + trailing_newlines(string)
 
-# Deserialization based on tdesktop source code
-# https://github.com/telegramdesktop/tdesktop/blob/7e071c770f7691ffdbbbd38ac3e17c9aae4d21b3/Telegram/SourceFiles/export/output/export_output_json.cpp#L26-L70
-#
-# TODO: Implement the last two 'if else' statements.
-def deserialize_string(text):
+def format_code(string):
+    return f'`{string.strip()}`' + trailing_newlines(string)
 
-    text.replace(r'\n', '\n')
-    text.replace(r'\r', '\r')
-    text.replace(r'\t', '\t')
-    text.replace(r'\"', '"')
-    text.replace(r'\\', '\\')
+def format_pre(string):
+    return f'```\n{string.strip()}\n```' + trailing_newlines(string)
+
+def format_underline(string):
+    return f'<u>{string.strip()}</u>' + trailing_newlines(string)
+
+def format_strikethrough(string):
+    return f'<s>{string.strip()}</s>' + trailing_newlines(string)
+
+
+@functools.lru_cache(maxsize=8192)
+def rewrite_link(link):
+
+    '''
+    converts telegram links to anchors,
+    this implies that telegram links are pointing to the same channel
+    '''
 
-    return text
+    if link.startswith('https://t.me/c/'):
+        return '#' + link.rsplit('/', 1)[-1]
+    return link
 
 # TODO: Put the inline image to the end of the Markdown file.
 def text_link_format(text, link):
@@ -129,16 +159,59 @@ def text_link_format(text, link):
         log.debug('The text is zero-width space, process as an inline image.')
         link_fmt = f'> ![]({link})\n\n'
     else:
-        # convert telegram links to anchors
-        # this implies that telegram links are pointing to the same channel
-        if link.startswith('https://t.me/c/'):
-            link = '#' + link.split('/')[-1]
         link_fmt = '[{text}]({href})'
-        link_fmt = link_fmt.format(text=text, href=link)
+        link_fmt = link_fmt.format(text=text, href=rewrite_link(link))
         link_fmt += '\n' * text.count('\n') * text.endswith('\n')
 
     return link_fmt
 
+def format_link(obj):
+
+    '''
+    wraps link in angle brackets, adds https:// scheme to bare links
+    '''
+
+    return add_link_scheme(obj['text'].strip(), obj['type'])
+
+@functools.lru_cache(maxsize=8192)
+def add_link_scheme(link, obj_type):
+    link = 'https://' * (obj_type == 'link') * \
+        (1 - link.startswith('https://')) + link
+    return f'<{link}>'
+
+EMOJI_ESCAPE_RE = re.compile(r'([ \\/()])')
+
+def format_custom_emoji(obj):
+
+    '''
+    converts custom emoji to markdown image link
+    '''
+
+    document_id = EMOJI_ESCAPE_RE.sub(r'\\\1', obj['document_id'])
+    return f'![{obj["text"]}]({document_id})\n\n'
+
+# text object type -> formatter, hashtags are collected by parse_tags()
+# the texts are already unescaped by the JSON parser
+TEXT_OBJECT_HANDLERS = {
+    'text_link': lambda obj: text_link_format(obj['text'], obj['href']),
+    'link': format_link,
+    'email': format_link,
+    'phone': lambda obj: obj['text'],
+    'italic': lambda obj: format_italic(obj['text']),
+    'bold': lambda obj: format_bold(obj['text']),
+    'code': lambda obj: format_code(obj['text']),
+    'pre': lambda obj: format_pre(obj['text']),
+    'underline': lambda obj: format_underline(obj['text']),
+    'strikethrough': lambda obj: format_strikethrough(obj['text']),
+    'plain': lambda obj: obj['text'],
+    'bank_card': lambda obj: obj['text'],
+    'mention': lambda obj: 'https://t.me/{}'.format(obj['text'][1:]),
+    'blockquote': lambda obj: f'> {obj["text"]}',
+    'custom_emoji': format_custom_emoji,
+    'spoiler': lambda obj: f'> [!info]\n> {obj["text"]}\n\n',
+    'hashtag': lambda obj: None,
+}
+
 def parse_text_object(post_id, obj, stickers_dir):
 
     # https://github.com/telegramdesktop/tdesktop/blob/7e071c770f7691ffdbbbd38ac3e17c9aae4d21b3/Telegram/SourceFiles/export/output/export_output_json.cpp#L164-L189
@@ -154,85 +227,34 @@ def parse_text_object(post_id, obj, stickers_dir):
     '''
 
     obj_type = obj['type']
-    obj_text = deserialize_string(obj['text'])
 
     log.debug("Process the '%s' object of the post #%i with the content %r.", \
                obj_type, post_id, obj)
 
-    if obj_type == 'text_link':
-        return text_link_format(obj_text, obj['href'])
-
-    elif obj_type in ('link', 'email'):
-        link = obj_text.strip()
-        link = 'https://' * (obj_type == 'link') * \
-            (1 - link.startswith('https://')) + link
-        return f'<{link}>'
-
-    elif obj_type == 'phone':
-        return obj_text
-
-    elif obj_type == 'italic':
-        return text_format(obj_text, '*')
-
-    elif obj_type == 'bold':
-        return text_format(obj_text, '**')
-
-    elif obj_type == 'code':
-        return text_format(obj_text, '`')
-
-    elif obj_type == 'pre':
-        return text_format(obj_text, '```')
-
-    elif obj_type == 'underline':
-        return text_format(obj_text, 'u')
-
-    elif obj_type == 'strikethrough':
-        return text_format(obj_text, 's')
-
-    elif obj_type == 'plain':
-        return obj_text
-
-    elif obj_type == 'bank_card':
-        return obj_text
-
-    elif obj_type == 'mention':
-        return 'https://t.me/{}'.format(obj_text[1:])
-
-    elif obj_type == 'blockquote':
-        return f'> {obj_text}'
-
-    elif obj_type == 'custom_emoji':
-        document_id = obj['document_id']
-        document_id = re.sub(r'( |\\|/|\(|\))', r'\\\g<1>', obj['document_id'])
-        return f'![{obj_text}]({document_id})\n\n'
-
-    elif obj_type == 'spoiler':
-        return f'> [!info]\n> {obj_text}\n\n'
-
-    elif obj_type == 'hashtag':
-        return None
-
-    else:
+    handler = TEXT_OBJECT_HANDLERS.get(obj_type)
+    if handler is None:
         log.warning("Cannot format the '%s' object type of the post #%i.", obj_type, post_id)
         return None
 
+    return handler(obj)
+
 # TODO: do not parse the sequence 'hashtag' 'plain' 'hashtag' 'plain' $
 def parse_post_text(post, stickers_dir):
     # TODO: handle reply-to
     post_id = post['id']
-    post_raw_text = post['text_entities']
-    post_parsed_text = ''
 
-    if isinstance(post_raw_text, str):
-        return str(post_raw_text)
+    # the text is exported as a plain string when it has no formatting
+    if (post_text := post.get('text')).__class__ is str:
+        return post_text
+
+    post_raw_text = post['text_entities']
+    post_parsed_text = []
 
     for obj in post_raw_text:
-        if isinstance(post_raw_text, str):
-            post_parsed_text += obj
-        elif (text := parse_text_object(post_id, obj, stickers_dir)) is not None:
-            post_parsed_text += str(text)
+        if (text := parse_text_object(post_id, obj, stickers_dir)) is not None:
+            post_parsed_text.append(text)
 
-    return post_parsed_text
+    return ''.join(post_parsed_text)
 
 def parse_post_media(post, media_dir):
 
@@ -248,23 +270,156 @@ def parse_post_media(post, media_dir):
 def parse_post(post, photo_dir, media_dir, stickers_dir):
 
     '''
-    converts post object to formatted text
+    converts post object to formatted UTF-8 encoded text
     '''
 
-    post_output = ''
+    post_output = []
 
     # optional image
     if 'photo' in post:
-        post_output += str(parse_post_photo(post, photo_dir))
+        post_output.append(parse_post_photo(post, photo_dir))
 
     # optional media
     if 'media_type' in post:
-        post_output += str(parse_post_media(post, media_dir))
+        post_output.append(parse_post_media(post, media_dir))
 
     # post text
-    post_output += str(parse_post_text(post, stickers_dir))
+    post_output.append(parse_post_text(post, stickers_dir))
+
+    return ''.join(post_output).encode('utf-8')
 
-    return post_output
+
+def iter_messages(json_file):
+
+    '''
+    yields messages of the export one by one
+    '''
+
+    with open(json_file, 'rb') as f:
+        yield from ijson.items(f, 'messages.item', use_float=True)
+
+
+def load_export(json_file):
+
+    '''
+    returns channel id and messages of the export,
+    messages are streamed with ijson when it is available
+    '''
+
+    if ijson is None:
+        with open(json_file, 'rb') as f:
+            data = _json.loads(f.read())
+        return data['id'], data['messages']
+
+    # the id comes before the messages, so only the head of the file is read
+    with open(json_file, 'rb') as f:
+        user_id = next(ijson.items(f, 'id'))
+
+    return user_id, iter_messages(json_file)
+
+
+def write_file(path, payload):
+
+    '''
+    writes payload bytes to path with a single write call
+    '''
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # a short write either finishes on the next call or raises
+        view = memoryview(payload)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def setup_logging(log_level):
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s - %(message)s', \
+                        level=log_level.upper())
+
+
+def convert_post(post, options):
+
+    '''
+    converts message post to markdown file in the output directory
+    '''
+
+    self_id, out_prefix, photo_dir, media_dir, stickers_dir = options
+
+    post_date = datetime.fromisoformat(post['date'])
+    post_path = out_prefix + post['date'][:10] + '-' + str(post['id']) + '.md'
+
+    # https://github.com/telegramdesktop/tdesktop/blob/7e071c770f7691ffdbbbd38ac3e17c9aae4d21b3/Telegram/SourceFiles/export/data/export_data_types.cpp#L244
+    # const auto text = QString::fromUtf8(data.v);
+    post_header = print_default_post_header(post, self_id, post_date)
+    post_body = parse_post(post, photo_dir, media_dir, stickers_dir)
+    payload = post_header + b'\n' + post_body + b'\n'
+
+    write_file(post_path, payload)
+
+
+def convert_posts(options, posts):
+
+    '''
+    converts a chunk of message posts, runs in worker processes
+    '''
+
+    for post in posts:
+        convert_post(post, options)
+
+
+# message fields read by the converter
+POST_FIELDS = ('id', 'date', 'text', 'text_entities', 'photo', 'media_type', 'file',
+               'from', 'from_id', 'forwarded_from', 'saved_from')
+
+def trim_message(post):
+    return {key: post[key] for key in POST_FIELDS if key in post}
+
+def skip_unsupported_post(post):
+    log.warning("The type of post #%i is '%s' and it is not supported.", \
+                 post['id'], post.get('type'))
+    return None
+
+def skip_service_post(post):
+    if post.get('action') != 'clear_history':
+        return skip_unsupported_post(post)
+
+    log.debug("The type of post #%i is 'service' and the action is 'clear_history'.", \
+              post['id'])
+    return None
+
+# post type -> handler returning the message to convert or None
+POST_TYPE_HANDLERS = {
+    'message': trim_message,
+    'service': skip_service_post,
+}
+
+def iter_message_chunks(raw_posts, chunk_size=256):
+
+    '''
+    filters out non-message posts and groups messages into chunks,
+    messages are trimmed to POST_FIELDS before sending to workers
+    '''
+
+    chunk = []
+    for post in raw_posts:
+        handler = POST_TYPE_HANDLERS.get(post.get('type'), skip_unsupported_post)
+        if (message := handler(post)) is not None:
+            chunk.append(message)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return number
 
 
 def main():
@@ -286,6 +441,11 @@ def main():
             nargs='?', default='warn',
             help='Set the logging level (e.g., debug, info, warning,\
                     error, critical)')
+    parser.add_argument(
+            '--jobs', metavar='jobs',
+            nargs='?', type=positive_int, default=None,
+            help='number of worker processes\
+                    (default: number of CPUs)')
     args_wip = parser.add_argument_group('work in progress')
     args_wip.add_argument(
             '--post-header', metavar='post_header',
@@ -313,45 +473,36 @@ def main():
 
     args = parser.parse_args()
 
-    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s - %(message)s', \
-                        level=args.log_level.upper())
+    setup_logging(args.log_level)
 
     try:
         os.mkdir(args.out_dir)
     except FileExistsError:
         pass
 
-    # load json file
+    # load messages and user_id
     try:
-        with open(args.json, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        user_id, raw_posts = load_export(args.json)
     except FileNotFoundError:
         sys.exit('result.json not found.\nPlease, specify right file')
 
-    # load messages and user_id
-    user_id = data['id']
-    raw_posts = data['messages']
+    self_id = f'user{user_id}'
 
-    for post in raw_posts:
-        if post['type'] == 'message':
-
-            post_date = datetime.fromisoformat(post['date'])
-            post_filename = str(post_date.date()) + '-' + str(post['id']) + '.md'
-            post_path = os.path.join(args.out_dir, post_filename)
-
-            # https://github.com/telegramdesktop/tdesktop/blob/7e071c770f7691ffdbbbd38ac3e17c9aae4d21b3/Telegram/SourceFiles/export/data/export_data_types.cpp#L244
-            # const auto text = QString::fromUtf8(data.v);
-            with open(post_path, 'w', encoding='utf-8') as f:
-                print(print_default_post_header(post, user_id), file=f)
-                print(parse_post(post, args.photo_dir, args.media_dir, args.stickers_dir), file=f)
-
-        elif post['type'] == 'service' and post['action'] == 'clear_history':
-            log.debug("The type of post #%i is 'service' and the action is 'clear_history'.", \
-                      post['id'])
-            continue
-        else:
-            log.warning("The type of post #%i is '%s' and it is not supported.", \
-                         post['id'], post['type'])
+    # output directory with a trailing separator
+    out_prefix = os.path.join(args.out_dir, '')
+
+    options = (self_id, out_prefix, args.photo_dir, args.media_dir, args.stickers_dir)
+    chunks = iter_message_chunks(raw_posts)
+
+    if args.jobs == 1:
+        for chunk in chunks:
+            convert_posts(options, chunk)
+        return
+
+    with multiprocessing.Pool(args.jobs, initializer=setup_logging,
+                              initargs=(args.log_level,)) as pool:
+        for _ in pool.imap_unordered(functools.partial(convert_posts, options), chunks):
+            pass
 
 if __name__ == '__main__':
     main()